@@ -2,9 +2,17 @@
 import sys
 import csv
 import re
+import io
+import gzip
+import lzma
+import ast
+import inspect
+import os
+from collections import deque
 
-def csv2model(reactionfile,parameterfile,ratelawfile,outputFile,paramType="inline"):
+def csv2model(reactionfile,parameterfile,ratelawfile,outputFile,paramType="inline",paramJac=False,costReport=False,stream=False,loopFamilies=False,minFamilySize=10,instrument="",instrumentChunkSize=100,cells=1,exchangeFile="",staticArrays=False,maxStaticSpecies=20,reorder=False,delayChain=0):
     scanIncludesFileName="scanIncludes.jl"
+    paramJacFileName="paramJac.jl"
     ODEDict=dict()
     print(paramType)
     if paramType == "inline":
@@ -19,12 +27,24 @@ If this is incorrect, please re-run with 5th argument set to \'inline\' or \'par
 re-run with the 5th argument set to \'scan\' or \'inline\'')
     else:
         print('The final argument was not recognised, please choose either \'scan\', \'inline\' or \'param\'')
+    #all the options that count something are checked here
+    cells=wholeNumberOption('cells',cells,1)
+    minFamilySize=wholeNumberOption('minFamilySize',minFamilySize,10)
+    instrumentChunkSize=wholeNumberOption('instrumentChunkSize',instrumentChunkSize,100)
+    maxStaticSpecies=wholeNumberOption('maxStaticSpecies',maxStaticSpecies,20)
+    #delayChain=0 (or false) keeps the delays for a DDE solver
+    delayChain=wholeNumberOption('delayChain',0 if delayChain is False else delayChain,0,minimum=0)
     print('Opening {file} as rate law file'.format(file=ratelawfile))    
     ratelaws=dict()
     delayDict=dict()
+    timeDependentDict=dict()
     ODEIndexDict=dict()
+    lawNameDict=dict()
+    familyDict=dict()
+    interactionDict=dict()
+    delayChainDict=dict()
     #let's populate a string array of rate laws
-    with open(ratelawfile,'r') as f:
+    with openInput(ratelawfile) as f:
         csvreader=csv.reader(f)
         #skip header row
         next(csvreader)
@@ -38,200 +58,878 @@ re-run with the 5th argument set to \'scan\' or \'inline\'')
     parametersIndexDict=dict()
     parametersIndexValueList=[]
     parametersNameList=[]
-    lineIndex=1
-    with open(parameterfile,'r') as f:
+    tdParametersValueList=[]
+    tdParametersNameList=[]
+    with openInput(parameterfile) as f:
         csvreader=csv.reader(f)
         #skpip header row
         next(csvreader)
 
         for line in csvreader:
             parametersDict[line[0].strip()]=str(line[1].strip())
-            parametersIndexDict[line[0].strip()]=lineIndex
-            parametersIndexValueList.append(str(line[1].strip()))
-            parametersNameList.append(line[0].strip())
-            lineIndex=lineIndex+1
+            #constant and time-dependent parameters are numbered separately, so that in param mode
+            #p is a Float64 array and each forcing function is written as a named function tdParam_<name>(t)
+            if "(t)" in line[1]:
+                tdParametersValueList.append(str(line[1].strip()))
+                tdParametersNameList.append(line[0].strip())
+                parametersIndexDict[line[0].strip()]=len(tdParametersNameList)
+            else:
+                parametersIndexValueList.append(str(line[1].strip()))
+                parametersNameList.append(line[0].strip())
+                parametersIndexDict[line[0].strip()]=len(parametersNameList)
 
+    if stream:
+        streamODEFile(reactionfile,outputFile,ratelaws,parametersDict,parametersIndexDict,paramType,parameterfile,ratelawfile)
+        if delayChain:
+            print('delayChain is not available with stream=true, delays were written for a DDE solver')
+        if reorder:
+            print('reorder is not available with stream=true, species are numbered in the order they are read')
+        if staticArrays:
+            print('staticArrays is not available with stream=true, an in-place model was written')
+        if cells>1:
+            print('cells is not available with stream=true, a single cell model was written')
+            cells=1
+        if loopFamilies:
+            print('loopFamilies is not available with stream=true, all reactions were written out in full')
+        if instrument:
+            print('instrument is not available with stream=true, the model was written without timers')
+    else:
+        #let's iterate through the reaction file
+        print('Opening {file} as reactions file'.format(file=reactionfile))
+        with openInput(reactionfile) as f:
+            csvreader=csv.reader(f)
+            #skip header row
+            next(csvreader)
+            for line in csvreader:
+                thisFamilyKey=familyKey(line,ratelaws,parametersDict) if loopFamilies else None
+                if thisFamilyKey:
+                    #family reactions are written as loops later, for now only their species are numbered
+                    familyDict.setdefault(thisFamilyKey,[]).append(line)
+                    for species in list(filter(None,line[0].strip().split(' ')))+list(filter(None,line[1].strip().split(' ')))+list(filter(None,line[3].strip().split(' '))):
+                        addODESpecies(ODEDict,ODEIndexDict,species)
+                    addInteractions(interactionDict,line,delayChain,delayChainDict)
+                    continue
+                substratesInThisRxn,productsInThisRxn,modifiersInThisRxn,kineticlaw,thisLaw=renderReaction(line,ratelaws,parametersDict,parametersIndexDict,paramType,delayDict,timeDependentDict,delayChain,delayChainDict)
+                lawNameDict[thisLaw]=kineticlaw
+                addInteractions(interactionDict,line,delayChain,delayChainDict)
+                #we need to add this reaction to every product and substrate involved in this reaction
+                #the net stoichiometry is accumulated per species so catalysts cancel and duplicates merge
+                for thisSubstrate in substratesInThisRxn:
+                    addODETerm(ODEDict,ODEIndexDict,thisSubstrate,thisLaw,-1)
+                for thisProduct in productsInThisRxn:
+                    addODETerm(ODEDict,ODEIndexDict,thisProduct,thisLaw,1)
+                #sometimes a modifier needs an ODE but has no changes other than events
+                for thisModifier in modifiersInThisRxn:
+                    if thisModifier not in ODEDict and not thisModifier.startswith("delay("):
+                    #if thisModifier not in ODEDict:
+                        ODEDict[thisModifier]=dict()
+                        ODEIndexDict[len(ODEDict)]=thisModifier
+        #laws used by too few reactions are written out in full like any other reaction
+        for thisFamilyKey in list(familyDict.keys()):
+            if len(familyDict[thisFamilyKey])<minFamilySize:
+                for line in familyDict.pop(thisFamilyKey):
+                    substratesInThisRxn,productsInThisRxn,modifiersInThisRxn,kineticlaw,thisLaw=renderReaction(line,ratelaws,parametersDict,parametersIndexDict,paramType,delayDict,timeDependentDict,delayChain,delayChainDict)
+                    lawNameDict[thisLaw]=kineticlaw
+                    for thisSubstrate in substratesInThisRxn:
+                        addODETerm(ODEDict,ODEIndexDict,thisSubstrate,thisLaw,-1)
+                    for thisProduct in productsInThisRxn:
+                        addODETerm(ODEDict,ODEIndexDict,thisProduct,thisLaw,1)
+        if delayChain and not addDelayChains(ODEDict,ODEIndexDict,interactionDict,delayChainDict,delayChain,lawNameDict):
+            return
+        if reorder:
+            ODEIndexDict=reorderSpecies(ODEIndexDict,interactionDict)
+        familyConstants,familyLoops=renderFamilies(familyDict,ratelaws,parametersDict,parametersIndexDict,paramType,ODEIndexDict,outputFile.split(".")[0])
+        #when timing per rate law every rendered law is evaluated once into a v_ local
+        lawVariables=dict()
+        if instrument=="law":
+            for species in ODEDict.keys():
+                for law,coefficient in ODEDict[species].items():
+                    if coefficient!=0 and law not in lawVariables:
+                        lawVariables[law]='v_'+str(len(lawVariables)+1)
+        elif instrument not in ("","family","chunk"):
+            print('instrument was not recognised, please choose either \'law\', \'family\' or \'chunk\'')
+        if cells>1 and (paramType!="param" or len(familyDict)>0 or instrument):
+            print('cells needs the 5th argument set to \'param\' and cannot be combined with loopFamilies or instrument, a single cell model was written')
+            cells=1
+        #the static form only avoids allocations when every parameter access is type stable,
+        #which paramFun/modify in scan mode and user functions inlined for time-dependent parameters are not
+        useStaticArrays=staticArrays and cells==1 and len(ODEIndexDict)<=maxStaticSpecies and len(familyDict)==0 and not instrument and (paramType=="param" or (paramType=="inline" and len(timeDependentDict)==0))
+        if staticArrays and not useStaticArrays:
+            print('staticArrays is only used with \'param\' (or \'inline\' without time-dependent parameters) for models with at most {number} species and without loopFamilies, instrument or cells, an in-place model was written'.format(number=maxStaticSpecies))
+        #print(ODEDict)
+        if cells>1:
+            exchangeList=readExchangeFile(exchangeFile,ODEDict,parametersDict,parametersIndexDict) if exchangeFile else []
+            writeMultiCellODEFile(netStoichiometryToODEs(ODEDict,ODEIndexDict,lawVariables),outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersNameList),timeDependentDict,cells,exchangeList)
+        elif useStaticArrays:
+            writeStaticODEFile(netStoichiometryToODEs(ODEDict,ODEIndexDict,lawVariables),outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersDict),timeDependentDict)
+        else:
+            writeODEFile(netStoichiometryToODEs(ODEDict,ODEIndexDict,lawVariables),outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersDict),timeDependentDict,familyConstants,familyLoops,instrument,instrumentChunkSize,lawVariables,lawNameDict)
+    if paramType=="scan":
+        writeParamFile(scanIncludesFileName,parametersDict)
+    elif paramType=="param":
+        writePfile(scanIncludesFileName,parametersNameList,parametersIndexValueList,tdParametersNameList,tdParametersValueList,cells)
+    if stream and (paramJac or costReport):
+        print('paramJac and costReport need the whole model in memory and are not available with stream=true')
+    elif len(familyDict)>0 and (paramJac or costReport):
+        print('paramJac and costReport are not available for reactions written as loops, re-run without loopFamilies')
+    elif cells>1 and paramJac:
+        print('paramJac is not available with cells, no paramjac! file written')
+    elif paramJac:
+        if paramType!="param":
+            print('paramJac is only available with the 5th argument set to \'param\', no paramjac! file written')
+        elif len(delayDict)>0:
+            print('paramJac is not available for models with delays, no paramjac! file written')
+        else:
+            writeParamJacFile(paramJacFileName,ODEDict,ODEIndexDict,timeDependentDict,parametersNameList)
+    if costReport and not stream and len(familyDict)==0:
+        writeCostReport(os.path.splitext(outputFile)[0]+'_cost.csv',ODEDict,ODEIndexDict,lawNameDict)
+           
+def renderReaction(line,ratelaws,parametersDict,parametersIndexDict,paramType,delayDict,timeDependentDict,delayChain,delayChainDict):
+    #substitute the species and parameters of one reactions file row into its rate law
+    #substrate, products, kinetic law, modifiers, parameters
+    substrates=line[0].strip()
+    products=line[1].strip()
+    kineticlaw=line[2].strip()
+    modifiers=line[3].strip()
+    parameters=line[4].strip()
+
+    #split up substrates, products, modifiers and parameters by space
+    substratesInThisRxn=substrates.split(' ')
+    substratesInThisRxn=list(filter(None,substratesInThisRxn))
+    productsInThisRxn=products.split(' ')
+    productsInThisRxn=list(filter(None,productsInThisRxn))
+    modifiersInThisRxn=modifiers.split(' ')
+    modifiersInThisRxn=list(filter(None,modifiersInThisRxn))
+    parametersInThisRxn=parameters.split(' ')
+    parametersInThisRxn=list(filter(None,parametersInThisRxn))
+    #print(substratesInThisRxn)
+
+
+    #print(ratelaws.keys())
+    #lookup kinetic law
+
+    thisLaw=ratelaws[kineticlaw]
+
+    #now we need to go through products substrates modifiers and variable using regular expressions
+    # we will substitute in the correct values from each table
+    #substrates
+
+    splitLaw=re.split('(\[[sS]\d{0,10}\])',thisLaw)
+    newLaw=[]
+    substrateIndex=0
+    try:
+        for part in splitLaw:
+            if(part and part.startswith('[') and re.search('([sS]\d{0,10})',part)):
+                substrateIndex=int(part[2:len(part)-1])-1
+                newLaw+=substratesInThisRxn[substrateIndex]
+            else:
+                newLaw+=list(part)
+
+        thisLaw="".join(newLaw)
+        #print(newLaw)
+    except:
+        print('error addding substrates {substrateIndex} to reaction {line}'.format(substrateIndex=substrateIndex, line=line))
+
+    #products
+    splitLaw=re.split('(\[[pP]\d{0,10}\])',thisLaw)
+    newLaw=[]
+    try:
+        for part in splitLaw:
+            if(part and part.startswith('[') and re.search('([pP]\d{0,10})',part)):
+                productIndex=int(part[2:len(part)-1])-1
+                newLaw+=productsInThisRxn[productIndex]
+            else:
+                newLaw+=list(part)
+    except:
+        print('error addding products {productIndex} to reaction {line}'.format(productIndex=productIndex, line=line))
+    thisLaw="".join(newLaw)
+
+    #modifiers
+    splitLaw=re.split('(\[[mM][Oo][Dd]\d{0,10}\])',thisLaw)
+    newLaw=[]
+    modifierIndex=0
+    try:
+        for part in splitLaw:
+            if(part and part.startswith('[') and re.search('[mM][Oo][Dd]\d{0,10}',part)):
+                modifierIndex=int(part[4:len(part)-1])-1
+                thisModifier=modifiersInThisRxn[modifierIndex]
+                if(thisModifier.startswith('delay(')):
+                    #cut the word delay and brackets out
+                    thisModifier=thisModifier[6:len(thisModifier)-1]
+                    thisModDelayProperties=thisModifier.split(',')
+                    thisMod=thisModDelayProperties[0]
+                    thisModDelay=thisModDelayProperties[1]
+                    if delayChain:
+                        #the delayed species is approximated by the last compartment of a chain of ODEs
+                        if (thisMod,thisModDelay) not in delayChainDict:
+                            delayChainDict[(thisMod,thisModDelay)]=thisMod+'_delay'+str(len(delayChainDict)+1)
+                        newLaw+=delayChainDict[(thisMod,thisModDelay)]+'_'+str(delayChain)
+                    else:
+                        thisDelayIndex=str(len(delayDict))
+                        newLaw+='(h(p,t-tau_'+thisMod+'_'+thisDelayIndex+')[histindex_'+thisMod+'])'
+                        delayDict[thisMod+'_'+thisDelayIndex]=thisModDelay
+                else:
+                    newLaw+=modifiersInThisRxn[modifierIndex]
+            else:
+                newLaw+=list(part)
+    except:
+        print('error addding modifiers {modifierIndex} to reaction {line}'.format(modifierIndex=modifierIndex, line=line))
+    thisLaw="".join(newLaw)
 
-    #let's iterate through the reaction file
-    print('Opening {file} as reactions file'.format(file=reactionfile))
-    with open(reactionfile,'r') as f:
+
+    #parameters
+    splitLaw=re.split('\{(\w{1,20})\}',thisLaw)
+    listLength=len(splitLaw)
+    newLaw=[]
+    currentParamInfo=0
+    try:
+        for i in range(listLength):
+            if splitLaw[i]:
+                parameterAdded=0
+                for j in range(len(parametersInThisRxn)):
+                    currentParamInfo=parametersInThisRxn[j]
+                    thisParameterType=str.split(parametersInThisRxn[j],'_')[0]
+
+                    #if splitLaw[i].startswith(thisParameterType):
+                    if splitLaw[i]==thisParameterType:
+                        if paramType=="scan":
+                            if "(t)" not in parametersDict[parametersInThisRxn[j]]:
+                                newLaw+=list("paramFun(\""+str(parametersInThisRxn[j])+"\",modify)")
+                            else:
+                                newLaw+=list(addTimeDependentParam(timeDependentDict,parametersInThisRxn[j],str(parametersDict[parametersInThisRxn[j]])))
+                            parameterAdded=1
+                        elif paramType=="param":
+                            thisParamVal=str(parametersDict[parametersInThisRxn[j]])
+                            if "(t)" in thisParamVal:
+                                newLaw+=list(addTimeDependentParam(timeDependentDict,parametersInThisRxn[j],"tdParam_"+parametersInThisRxn[j]+"(t)"))
+                            else:
+                                newLaw+=list("p["+str(parametersIndexDict[parametersInThisRxn[j]])+"]")
+                            parameterAdded=1
+                        else:
+                            thisParamVal=str(parametersDict[parametersInThisRxn[j]])
+                            if "(t)" in thisParamVal:
+                                newLaw+=list(addTimeDependentParam(timeDependentDict,parametersInThisRxn[j],thisParamVal))
+                            else:
+                                newLaw+=list(thisParamVal)
+                            parameterAdded=1
+                else:
+                    if not parameterAdded:
+                        newLaw+=splitLaw[i]
+
+
+    except:
+        print('error addding parameters {parametersInThisRxn} to reaction {line}\n'.format(parametersInThisRxn=parametersInThisRxn, line=line))
+        print('error addding parameter: {currentParamInfo}\n'.format(currentParamInfo=currentParamInfo) )
+    thisLaw="".join(newLaw)
+    return substratesInThisRxn,productsInThisRxn,modifiersInThisRxn,kineticlaw,thisLaw
+
+def addDelayChains(ODEDict,ODEIndexDict,interactionDict,delayChainDict,delayChain,lawNameDict):
+    #linear chain trick: a delay tau of species X is replaced by delayChain compartments
+    #dz1=(n/tau)*(X-z1), dzk=(n/tau)*(z(k-1)-zk), and the delayed X is read from the last one.
+    #returns False if a delayed species is not in the model
+    missingSpecies=[thisMod for thisMod,thisModDelay in delayChainDict.keys() if thisMod not in ODEDict]
+    if missingSpecies:
+        print('error adding delay chains for {species}, not species in the model, no model written'.format(species=', '.join(missingSpecies)))
+        return False
+    numberOfSpecies=len(ODEIndexDict)
+    for (thisMod,thisModDelay),chainName in delayChainDict.items():
+        rate='('+str(delayChain)+'/('+thisModDelay+'))'
+        previousCompartment=thisMod
+        for compartmentIndex in range(1,delayChain+1):
+            compartment=chainName+'_'+str(compartmentIndex)
+            for term,coefficient in ((rate+'*'+previousCompartment,1),(rate+'*'+compartment,-1)):
+                addODETerm(ODEDict,ODEIndexDict,compartment,term,coefficient)
+                lawNameDict[term]='delay chain'
+            interactionDict.setdefault(compartment,set()).add(previousCompartment)
+            interactionDict.setdefault(previousCompartment,set()).add(compartment)
+            previousCompartment=compartment
+    print('{chains} delays replaced by chains of {length} compartments, {added} states added to the {species} species'.format(
+        chains=len(delayChainDict),length=delayChain,added=len(ODEIndexDict)-numberOfSpecies,species=numberOfSpecies))
+    return True
+
+def addInteractions(interactionDict,line,delayChain,delayChainDict):
+    #species in the same reaction can change each other, so they share an edge in the species graph.
+    #a delayed species affects the rate through its history, or through the last compartment of its chain
+    speciesInThisRxn=[]
+    for species in filter(None,(line[0].strip()+' '+line[1].strip()+' '+line[3].strip()).split(' ')):
+        if species.startswith('delay('):
+            thisModDelayProperties=species[6:len(species)-1].split(',')
+            species=thisModDelayProperties[0]
+            #only delays the rate law reads have a chain
+            chainName=delayChainDict.get((thisModDelayProperties[0],thisModDelayProperties[1])) if delayChain else None
+            if chainName:
+                species=chainName+'_'+str(delayChain)
+        speciesInThisRxn.append(species)
+    for species in speciesInThisRxn:
+        interactionDict.setdefault(species,set())
+        for otherSpecies in speciesInThisRxn:
+            if otherSpecies!=species:
+                interactionDict[species].add(otherSpecies)
+
+def speciesBandwidth(ODEIndexDict,interactionDict):
+    odeNameDict=dict((ODEIndexDict[index],index) for index in ODEIndexDict.keys())
+    bandwidth=0
+    for species in interactionDict.keys():
+        for otherSpecies in interactionDict[species]:
+            if species in odeNameDict and otherSpecies in odeNameDict:
+                bandwidth=max(bandwidth,abs(odeNameDict[species]-odeNameDict[otherSpecies]))
+    return bandwidth
+
+def reorderSpecies(ODEIndexDict,interactionDict):
+    #reverse Cuthill-McKee ordering of the species graph, to bring the jacobian nonzeros close to the
+    #diagonal. Each connected part starts from its lowest degree species, ties keep the order species were read
+    speciesOrder=[ODEIndexDict[index] for index in sorted(ODEIndexDict.keys())]
+    readIndex=dict((species,index) for index,species in enumerate(speciesOrder))
+    neighbours=dict((species,[otherSpecies for otherSpecies in interactionDict.get(species,set()) if otherSpecies in readIndex]) for species in speciesOrder)
+    degree=lambda species:(len(neighbours[species]),readIndex[species])
+    visited=set()
+    newOrder=[]
+    for start in sorted(speciesOrder,key=degree):
+        if start in visited:
+            continue
+        visited.add(start)
+        queue=deque([start])
+        while queue:
+            species=queue.popleft()
+            newOrder.append(species)
+            for otherSpecies in sorted(neighbours[species],key=degree):
+                if otherSpecies not in visited:
+                    visited.add(otherSpecies)
+                    queue.append(otherSpecies)
+    newOrder.reverse()
+    reorderedIndexDict=dict((index+1,species) for index,species in enumerate(newOrder))
+    print('Species reordered, bandwidth {before} before and {after} after'.format(before=speciesBandwidth(ODEIndexDict,interactionDict),after=speciesBandwidth(reorderedIndexDict,interactionDict)))
+    with open('permutation.jl','w') as f:
+        f.write('#species i of the reordered model was species speciesPermutation[i] in the order they were read\n')
+        f.write('#e.g. y0=y0InReadOrder[speciesPermutation]\n')
+        f.write('speciesPermutation=[')
+        for species in newOrder:
+            f.write(str(readIndex[species]+1)+',')
+        f.write(']')
+    return reorderedIndexDict
+
+def familyKey(line,ratelaws,parametersDict):
+    #reactions sharing a rate law and its shape can be evaluated together in one loop.
+    #returns None for reactions that have to be written out in full
+    substratesInThisRxn=list(filter(None,line[0].strip().split(' ')))
+    productsInThisRxn=list(filter(None,line[1].strip().split(' ')))
+    kineticlaw=line[2].strip()
+    modifiersInThisRxn=list(filter(None,line[3].strip().split(' ')))
+    parametersInThisRxn=list(filter(None,line[4].strip().split(' ')))
+    if kineticlaw not in ratelaws:
+        return None
+    if any(thisModifier.startswith('delay(') for thisModifier in modifiersInThisRxn):
+        return None
+    if any(parameter not in parametersDict or "(t)" in parametersDict[parameter] for parameter in parametersInThisRxn):
+        return None
+    thisLaw=ratelaws[kineticlaw]
+    for pattern,speciesInThisRxn in (('\[[sS](\d{0,10})\]',substratesInThisRxn),('\[[pP](\d{0,10})\]',productsInThisRxn),('\[[mM][Oo][Dd](\d{0,10})\]',modifiersInThisRxn)):
+        for speciesIndex in re.findall(pattern,thisLaw):
+            if not speciesIndex or int(speciesIndex)<1 or int(speciesIndex)>len(speciesInThisRxn):
+                return None
+    #every parameter in the law has to match exactly one parameter of the reaction
+    for paramToken in re.findall('\{(\w{1,20})\}',thisLaw):
+        if len([parameter for parameter in parametersInThisRxn if parameter.split('_')[0]==paramToken])!=1:
+            return None
+    return (kineticlaw,len(substratesInThisRxn),len(productsInThisRxn),len(modifiersInThisRxn))
+
+def writeFamilyArray(familyName,rows,elementType):
+    #stored as columns*reactions so the indices of one reaction are contiguous in memory,
+    #one reaction per line of the file
+    arrayString='const '+familyName+'=reshape('+elementType+'[\n'
+    for row in rows:
+        arrayString+=','.join(row)+',\n'
+    return arrayString+'],'+str(len(rows[0]))+','+str(len(rows))+')\n'
+
+def renderFamilies(familyDict,ratelaws,parametersDict,parametersIndexDict,paramType,ODEIndexDict,odeFileName):
+    #each family gets index arrays (one column per reaction) for its substrates, products, modifiers
+    #and parameters, and a loop that evaluates the shared rate law for every column
+    odeNameDict=dict((ODEIndexDict[index],index) for index in ODEIndexDict.keys())
+    familyConstants=''
+    familyLoops=dict()
+    for familyIndex,thisFamilyKey in enumerate(familyDict.keys()):
+        kineticlaw=thisFamilyKey[0]
+        #named after the model so several models can be included together
+        familyName=odeFileName+'_family'+str(familyIndex+1)
+        thisLaw=ratelaws[kineticlaw]
+        paramTokens=[]
+        for paramToken in re.findall('\{(\w{1,20})\}',thisLaw):
+            if paramToken not in paramTokens:
+                paramTokens.append(paramToken)
+        substrateRows,productRows,modifierRows,paramRows=[],[],[],[]
+        for line in familyDict[thisFamilyKey]:
+            substrateRows.append([str(odeNameDict[species]) for species in filter(None,line[0].strip().split(' '))])
+            productRows.append([str(odeNameDict[species]) for species in filter(None,line[1].strip().split(' '))])
+            modifierRows.append([str(odeNameDict[species]) for species in filter(None,line[3].strip().split(' '))])
+            parametersInThisRxn=list(filter(None,line[4].strip().split(' ')))
+            paramRow=[]
+            for paramToken in paramTokens:
+                parameter=[parameter for parameter in parametersInThisRxn if parameter.split('_')[0]==paramToken][0]
+                if paramType=="param":
+                    paramRow.append(str(parametersIndexDict[parameter]))
+                elif paramType=="scan":
+                    paramRow.append('\"'+parameter+'\"')
+                else:
+                    paramRow.append(parametersDict[parameter])
+            paramRows.append(paramRow)
+        familyConstants+='#'+familyName+': '+kineticlaw+', '+str(len(familyDict[thisFamilyKey]))+' reactions\n'
+        if thisFamilyKey[1]>0:
+            familyConstants+=writeFamilyArray(familyName+'_S',substrateRows,'Int')
+        if thisFamilyKey[2]>0:
+            familyConstants+=writeFamilyArray(familyName+'_P',productRows,'Int')
+        if thisFamilyKey[3]>0:
+            familyConstants+=writeFamilyArray(familyName+'_M',modifierRows,'Int')
+        if len(paramTokens)>0:
+            familyConstants+=writeFamilyArray(familyName+'_K',paramRows,{'param':'Int','scan':'String'}.get(paramType,'Float64'))
+        familyConstants+='\n'
+
+        #the same substitutions as renderReaction, but through the family index arrays
+        familyLaw=re.sub('\[[sS](\d{1,10})\]',lambda m:'max(y['+familyName+'_S['+m.group(1)+',r]],0)',thisLaw)
+        familyLaw=re.sub('\[[pP](\d{1,10})\]',lambda m:'max(y['+familyName+'_P['+m.group(1)+',r]],0)',familyLaw)
+        familyLaw=re.sub('\[[mM][Oo][Dd](\d{1,10})\]',lambda m:'max(y['+familyName+'_M['+m.group(1)+',r]],0)',familyLaw)
+        if paramType=="param":
+            familyLaw=re.sub('\{(\w{1,20})\}',lambda m:'p['+familyName+'_K['+str(paramTokens.index(m.group(1))+1)+',r]]',familyLaw)
+        elif paramType=="scan":
+            familyLaw=re.sub('\{(\w{1,20})\}',lambda m:'paramFun('+familyName+'_K['+str(paramTokens.index(m.group(1))+1)+',r],modify)',familyLaw)
+        else:
+            familyLaw=re.sub('\{(\w{1,20})\}',lambda m:familyName+'_K['+str(paramTokens.index(m.group(1))+1)+',r]',familyLaw)
+        familyLoop='\t#'+familyName+': '+kineticlaw+'\n'
+        familyLoop+='\tfor r in 1:'+str(len(familyDict[thisFamilyKey]))+'\n'
+        familyLoop+='\t\tv='+familyLaw+'\n'
+        for substrateIndex in range(thisFamilyKey[1]):
+            familyLoop+='\t\tdy['+familyName+'_S['+str(substrateIndex+1)+',r]]-=v\n'
+        for productIndex in range(thisFamilyKey[2]):
+            familyLoop+='\t\tdy['+familyName+'_P['+str(productIndex+1)+',r]]+=v\n'
+        familyLoop+='\tend\n'
+        familyLoops[familyName+': '+kineticlaw]=familyLoop
+    return familyConstants,familyLoops
+
+def openInput(fileName):
+    #input tables may be gzip, xz or zstd compressed, chosen by file extension
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName,'rt')
+    elif fileName.endswith('.xz'):
+        return lzma.open(fileName,'rt')
+    elif fileName.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading {file} requires the zstandard package'.format(file=fileName))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(fileName,'rb')))
+    return open(fileName,'r')
+
+def writeModelHeader(f,reactionfile,parameterfile,ratelawfile,numberOfEquations,numberOfParameters,cells=1):
+    #banner at the top of every model file, whichever form the model is written in
+    f.write('#######################################################\n')
+    f.write('# Generated programmatically by CSV2JuliaDiffEq.      #\n')
+    f.write('# http://github.com/SiFTW/CSV2JuliaDiffEq             #\n')
+    f.write('#######################################################\n')
+    f.write('# generated from:\n')
+    f.write('#    reactions file: {file}\n'.format(file=reactionfile))
+    f.write('#    parameters file file: {file}\n'.format(file=parameterfile))
+    f.write('#    rate law file: {file}\n'.format(file=ratelawfile))
+    f.write('#\n')
+    f.write('# Statistics:\n')
+    f.write('#    Equations:{number}\n'.format(number=numberOfEquations))
+    f.write('#    Parameters:{number}\n'.format(number=numberOfParameters))
+    if cells>1:
+        f.write('#    Cells:{number}\n'.format(number=cells))
+    f.write('#######################################################\n\n')
+    f.write('\n\n')
+
+def writeVariableNames(ODEIndexDict,cells=1):
+    #species names in model order. with several cells, syms repeats them once per cell
+    with open('variableNames.jl','w') as f:
+        if cells>1:
+            f.write('speciesNames=[')
+            for line in ODEIndexDict.keys():
+                f.write('\"'+ODEIndexDict[line]+'\",')
+            f.write(']\n')
+            f.write('numberOfCells='+str(cells)+'\n')
+            f.write('syms=[s*\"_\"*string(c) for c in 1:numberOfCells for s in speciesNames]')
+        else:
+            f.write('syms=[')
+            for line in ODEIndexDict.keys():
+                f.write('\"'+ODEIndexDict[line]+'\",')
+            f.write(']')
+
+def streamODEFile(reactionfile,outputFile,ratelaws,parametersDict,parametersIndexDict,paramType,parameterfile,ratelawfile):
+    #each reaction is written as soon as it is rendered, so only species names are held in memory.
+    #a first pass over the reactions file assigns the species indices and finds any delays.
+    print('Streaming {file} as reactions file'.format(file=reactionfile))
+    ODEIndexDict=dict()
+    odeNameDict=dict()
+    hasDelays=False
+    with openInput(reactionfile) as f:
         csvreader=csv.reader(f)
         #skip header row
         next(csvreader)
         for line in csvreader:
-            #substrate, products, kinetic law, modifiers, parameters
-            substrates=line[0].strip()
-            products=line[1].strip()
-            kineticlaw=line[2].strip()
-            modifiers=line[3].strip()
-            parameters=line[4].strip()
-
-            #split up substrates, products, modifiers and parameters by space
-            substratesInThisRxn=substrates.split(' ')
-            substratesInThisRxn=list(filter(None,substratesInThisRxn))
-            productsInThisRxn=products.split(' ')
-            productsInThisRxn=list(filter(None,productsInThisRxn))
-            modifiersInThisRxn=modifiers.split(' ')
-            modifiersInThisRxn=list(filter(None,modifiersInThisRxn))
-            parametersInThisRxn=parameters.split(' ')
-            parametersInThisRxn=list(filter(None,parametersInThisRxn))
-            #print(substratesInThisRxn)
-
-
-            #print(ratelaws.keys())
-            #lookup kinetic law
-
-            thisLaw=ratelaws[kineticlaw]
-
-            #now we need to go through products substrates modifiers and variable using regular expressions
-            # we will substitute in the correct values from each table
-            #substrates
-
-            splitLaw=re.split('(\[[sS]\d{0,10}\])',thisLaw)
-            newLaw=[]
-            substrateIndex=0
-            try:
-                for part in splitLaw:
-                    if(part and part.startswith('[') and re.search('([sS]\d{0,10})',part)):
-                        substrateIndex=int(part[2:len(part)-1])-1
-                        newLaw+=substratesInThisRxn[substrateIndex]
-                    else:
-                        newLaw+=list(part)
-
-                thisLaw="".join(newLaw)
-                #print(newLaw)
-            except:
-                print('error addding substrates {substrateIndex} to reaction {line}'.format(substrateIndex=substrateIndex, line=line))
-
-            #products
-            splitLaw=re.split('(\[[pP]\d{0,10}\])',thisLaw)
-            newLaw=[]
-            try:
-                for part in splitLaw:
-                    if(part and part.startswith('[') and re.search('([pP]\d{0,10})',part)):
-                        productIndex=int(part[2:len(part)-1])-1
-                        newLaw+=productsInThisRxn[productIndex]
-                    else:
-                        newLaw+=list(part)
-            except:
-                print('error addding products {productIndex} to reaction {line}'.format(productIndex=productIndex, line=line))
-            thisLaw="".join(newLaw)
-
-            #modifiers
-            splitLaw=re.split('(\[[mM][Oo][Dd]\d{0,10}\])',thisLaw)
-            newLaw=[]
-            modifierIndex=0
-            try:
-                for part in splitLaw:
-                    if(part and part.startswith('[') and re.search('[mM][Oo][Dd]\d{0,10}',part)):
-                        modifierIndex=int(part[4:len(part)-1])-1
-                        thisModifier=modifiersInThisRxn[modifierIndex]
-                        if(thisModifier.startswith('delay(')):
-                            #cut the word delay and brackets out
-                            thisModifier=thisModifier[6:len(thisModifier)-1]
-                            thisModDelayProperties=thisModifier.split(',')
-                            thisMod=thisModDelayProperties[0]
-                            thisModDelay=thisModDelayProperties[1]
-                            thisDelayIndex=str(len(delayDict))
-                            newLaw+='(h(p,t-tau_'+thisMod+'_'+thisDelayIndex+')[histindex_'+thisMod+'])'
-                            delayDict[thisMod+'_'+thisDelayIndex]=thisModDelay
-                        else:
-                            newLaw+=modifiersInThisRxn[modifierIndex]
+            modifiersInThisRxn=list(filter(None,line[3].strip().split(' ')))
+            for species in list(filter(None,line[0].strip().split(' ')))+list(filter(None,line[1].strip().split(' ')))+modifiersInThisRxn:
+                if species.startswith('delay('):
+                    hasDelays=True
+                elif species not in odeNameDict:
+                    odeNameDict[species]=len(odeNameDict)+1
+                    ODEIndexDict[len(odeNameDict)]=species
+
+    with open(outputFile,'w') as f:
+        writeModelHeader(f,reactionfile,parameterfile,ratelawfile,len(ODEIndexDict),len(parametersDict))
+        odeFileName=outputFile.split(".")[0]
+        if hasDelays:
+            f.write('function {name}(dy,y,h,p,t)\n'.format(name=odeFileName))
+        else:
+            f.write('function {name}(dy,y,p,t)\n'.format(name=odeFileName))
+        for line in ODEIndexDict.keys():
+            f.write('\t'+ODEIndexDict[line]+'=maximum([y['+str(line)+'],0])\n')
+        f.write('\tfill!(dy,0)\n')
+        delayDict=dict()
+        timeDependentDict=dict()
+        histIndexWritten=set()
+        reactionIndex=0
+        with openInput(reactionfile) as reactions:
+            csvreader=csv.reader(reactions)
+            #skip header row
+            next(csvreader)
+            for line in csvreader:
+                reactionIndex+=1
+                numberOfDelays=len(delayDict)
+                numberOfTimeDependentParams=len(timeDependentDict)
+                substratesInThisRxn,productsInThisRxn,modifiersInThisRxn,kineticlaw,thisLaw=renderReaction(line,ratelaws,parametersDict,parametersIndexDict,paramType,delayDict,timeDependentDict,0,dict())
+                #locals first needed by this reaction are defined just before it
+                for paramName in list(timeDependentDict.keys())[numberOfTimeDependentParams:]:
+                    f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
+                for delayEntry in list(delayDict.keys())[numberOfDelays:]:
+                    f.write('\ttau_'+delayEntry+'='+delayDict[delayEntry]+'\n')
+                    odeName=delayEntry.split('_')[0]
+                    if odeName not in histIndexWritten:
+                        f.write('\thistindex_'+odeName+'='+str(odeNameDict[odeName])+'\n')
+                        histIndexWritten.add(odeName)
+                #net stoichiometry within this reaction, so catalysts still cancel
+                stoichiometry=dict()
+                for thisSubstrate in substratesInThisRxn:
+                    stoichiometry[thisSubstrate]=stoichiometry.get(thisSubstrate,0)-1
+                for thisProduct in productsInThisRxn:
+                    stoichiometry[thisProduct]=stoichiometry.get(thisProduct,0)+1
+                f.write('\t#'+' '.join(substratesInThisRxn)+' -> '+' '.join(productsInThisRxn)+', '+kineticlaw+'\n')
+                f.write('\tv_'+str(reactionIndex)+'='+thisLaw+'\n')
+                for species,coefficient in stoichiometry.items():
+                    if coefficient==0:
+                        continue
+                    sign='+=' if coefficient>0 else '-='
+                    coefficientString='' if abs(coefficient)==1 else str(abs(coefficient))+'*'
+                    f.write('\tdy['+str(odeNameDict[species])+']'+sign+coefficientString+'v_'+str(reactionIndex)+'\n')
+        f.write('\tnothing\n')
+        f.write('end\n')
+
+    writeVariableNames(ODEIndexDict)
+
+def addTimeDependentParam(timeDependentDict,paramName,paramExpression):
+    #time-dependent parameters are hoisted into a td_ local at the top of the ODE function
+    timeDependentDict[paramName]=paramExpression
+    return 'td_'+paramName
+
+def addODESpecies(ODEDict,ODEIndexDict,species):
+    if species not in ODEDict:
+        ODEDict[species]=dict()
+        ODEIndexDict[len(ODEDict)]=species
+
+def addODETerm(ODEDict,ODEIndexDict,species,law,coefficient):
+    #ODEDict maps each species to {rendered law: net integer stoichiometry}
+    addODESpecies(ODEDict,ODEIndexDict,species)
+    ODEDict[species][law]=ODEDict[species].get(law,0)+coefficient
+
+def netStoichiometryToODEs(ODEDict,ODEIndexDict,lawVariables):
+    #render the accumulated terms, dropping zero-net terms and writing repeated ones as n*(law).
+    #laws in lawVariables are referred to by the name of the local they were evaluated into
+    ODEStringDict=dict()
+    for index in ODEIndexDict.keys():
+        species=ODEIndexDict[index]
+        ODEString='dy['+str(index)+']='
+        for law,coefficient in ODEDict[species].items():
+            if coefficient==0:
+                continue
+            if law in lawVariables:
+                law=lawVariables[law]
+            sign=' + ' if coefficient>0 else ' - '
+            if abs(coefficient)==1:
+                ODEString+=sign+law
+            else:
+                ODEString+=sign+str(abs(coefficient))+'*('+law+')'
+        if ODEString.endswith('='):
+            ODEString+='0'
+        ODEStringDict[species]=ODEString
+    return ODEStringDict
+
+def lawToExpression(law):
+    #rendered laws are julia arithmetic, which python can parse once ^ is swapped for **
+    return ast.parse(law.replace('^','**'),mode='eval').body
+
+def expressionToLaw(expression):
+    return ast.unparse(expression).replace('**','^')
+
+def isParam(node,paramIndex):
+    return (isinstance(node,ast.Subscript) and isinstance(node.value,ast.Name) and node.value.id=='p'
+        and isinstance(node.slice,ast.Constant) and node.slice.value==paramIndex)
+
+def containsParam(node,paramIndex):
+    return any(isParam(child,paramIndex) for child in ast.walk(node))
+
+def paramsInExpression(node):
+    #the p[i] indices appearing in a rendered law
+    paramIndices=set()
+    for child in ast.walk(node):
+        if (isinstance(child,ast.Subscript) and isinstance(child.value,ast.Name) and child.value.id=='p'
+                and isinstance(child.slice,ast.Constant) and isinstance(child.slice.value,int)):
+            paramIndices.add(child.slice.value)
+    return paramIndices
+
+#zero derivatives are represented by None so they can be dropped as they propagate
+def addExpressions(a,b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return ast.BinOp(a,ast.Add(),b)
+
+def negExpression(a):
+    if a is None:
+        return None
+    if isinstance(a,ast.UnaryOp) and isinstance(a.op,ast.USub):
+        return a.operand
+    return ast.UnaryOp(ast.USub(),a)
+
+def subExpressions(a,b):
+    if b is None:
+        return a
+    if a is None:
+        return negExpression(b)
+    return ast.BinOp(a,ast.Sub(),b)
+
+def mulExpressions(a,b):
+    if a is None or b is None:
+        return None
+    if isinstance(a,ast.Constant) and a.value==1:
+        return b
+    if isinstance(b,ast.Constant) and b.value==1:
+        return a
+    return ast.BinOp(a,ast.Mult(),b)
+
+def divExpressions(a,b):
+    if a is None:
+        return None
+    return ast.BinOp(a,ast.Div(),b)
+
+def callExpression(name,argument):
+    return ast.Call(ast.Name(name,ast.Load()),[argument],[])
+
+def differentiateExpression(node,paramIndex):
+    #symbolic derivative of a parsed rate law with respect to p[paramIndex]
+    if not containsParam(node,paramIndex):
+        return None
+    if isParam(node,paramIndex):
+        return ast.Constant(1)
+    if isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.USub):
+        return negExpression(differentiateExpression(node.operand,paramIndex))
+    if isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.UAdd):
+        return differentiateExpression(node.operand,paramIndex)
+    if isinstance(node,ast.BinOp):
+        u,v=node.left,node.right
+        du=differentiateExpression(u,paramIndex)
+        dv=differentiateExpression(v,paramIndex)
+        if isinstance(node.op,ast.Add):
+            return addExpressions(du,dv)
+        if isinstance(node.op,ast.Sub):
+            return subExpressions(du,dv)
+        if isinstance(node.op,ast.Mult):
+            return addExpressions(mulExpressions(du,v),mulExpressions(u,dv))
+        if isinstance(node.op,ast.Div):
+            #(u'v-uv')/v^2
+            if dv is None:
+                return divExpressions(du,v)
+            return divExpressions(subExpressions(mulExpressions(du,v),mulExpressions(u,dv)),ast.BinOp(v,ast.Pow(),ast.Constant(2)))
+        if isinstance(node.op,ast.Pow):
+            if dv is None:
+                #n*u^(n-1)*u'
+                return mulExpressions(mulExpressions(v,ast.BinOp(u,ast.Pow(),ast.BinOp(v,ast.Sub(),ast.Constant(1)))),du)
+            #u^v*(v'*log(u)+v*u'/u)
+            return mulExpressions(node,addExpressions(mulExpressions(dv,callExpression('log',u)),divExpressions(mulExpressions(v,du),u)))
+    if isinstance(node,ast.Call) and isinstance(node.func,ast.Name) and len(node.args)==1:
+        u=node.args[0]
+        du=differentiateExpression(u,paramIndex)
+        if node.func.id=='exp':
+            return mulExpressions(node,du)
+        if node.func.id=='log':
+            return divExpressions(du,u)
+        if node.func.id=='sqrt':
+            return divExpressions(du,ast.BinOp(ast.Constant(2),ast.Mult(),node))
+        if node.func.id=='sin':
+            return mulExpressions(callExpression('cos',u),du)
+        if node.func.id=='cos':
+            return negExpression(mulExpressions(callExpression('sin',u),du))
+    raise ValueError('cannot differentiate {expression} with respect to p[{index}]'.format(expression=expressionToLaw(node),index=paramIndex))
+
+def writeParamJacFile(paramJacFileName,ODEDict,ODEIndexDict,timeDependentDict,parametersNameList):
+    #dy[i]/dp[k] is only written for the parameters that appear in equation i
+    paramJacLines=[]
+    try:
+        for index in ODEIndexDict.keys():
+            species=ODEIndexDict[index]
+            equationDerivatives=dict()
+            for law,coefficient in ODEDict[species].items():
+                if coefficient==0:
+                    continue
+                expression=lawToExpression(law)
+                for paramIndex in sorted(paramsInExpression(expression)):
+                    derivative=differentiateExpression(expression,paramIndex)
+                    if coefficient!=1 and coefficient!=-1:
+                        derivative=mulExpressions(ast.Constant(abs(coefficient)),derivative)
+                    if coefficient>0:
+                        equationDerivatives[paramIndex]=addExpressions(equationDerivatives.get(paramIndex),derivative)
                     else:
-                        newLaw+=list(part)
-            except:
-                print('error addding modifiers {modifierIndex} to reaction {line}'.format(modifierIndex=modifierIndex, line=line))
-            thisLaw="".join(newLaw)
-
-
-            #parameters
-            splitLaw=re.split('\{(\w{1,20})\}',thisLaw)
-            listLength=len(splitLaw)
-            newLaw=[]
-            currentParamInfo=0
-            try:
-                for i in range(listLength):
-                    if splitLaw[i]:
-                        parameterAdded=0
-                        for j in range(len(parametersInThisRxn)):
-                            currentParamInfo=parametersInThisRxn[j]
-                            thisParameterType=str.split(parametersInThisRxn[j],'_')[0]
-
-                            #if splitLaw[i].startswith(thisParameterType):
-                            if splitLaw[i]==thisParameterType:
-                                if paramType=="scan":
-                                    if "(t)" not in parametersDict[parametersInThisRxn[j]]:
-                                        newLaw+=list("paramFun(\""+str(parametersInThisRxn[j])+"\",modify)")
-                                    else:
-                                        newLaw+=list(str(parametersDict[parametersInThisRxn[j]]))                                    
-                                    parameterAdded=1
-                                elif paramType=="param":
-                                    thisParamVal=str(parametersDict[parametersInThisRxn[j]])
-                                    if "(t)" in thisParamVal:
-                                        newLaw+=list("p["+str(parametersIndexDict[parametersInThisRxn[j]])+"](t)")
-                                    else:
-                                        newLaw+=list("p["+str(parametersIndexDict[parametersInThisRxn[j]])+"]")
-                                    parameterAdded=1
-                                else:
-                                    newLaw+=list(str(parametersDict[parametersInThisRxn[j]]))
-                                    parameterAdded=1
-                        else:
-                            if not parameterAdded:
-                                newLaw+=splitLaw[i]
+                        equationDerivatives[paramIndex]=subExpressions(equationDerivatives.get(paramIndex),derivative)
+            for paramIndex in sorted(equationDerivatives.keys()):
+                if equationDerivatives[paramIndex] is not None:
+                    paramJacLines.append('\tpJ['+str(index)+','+str(paramIndex)+']='+expressionToLaw(equationDerivatives[paramIndex])
+                        +' #d('+species+')/d('+parametersNameList[paramIndex-1]+')\n')
+    except (SyntaxError,ValueError) as e:
+        print('error deriving paramjac! entry for {species}, no paramjac! file written: {error}'.format(species=species,error=e))
+        return
 
+    with open(paramJacFileName,'w') as f:
+        f.write('#######################################################\n')
+        f.write('# Generated programmatically by CSV2JuliaDiffEq.      #\n')
+        f.write('# http://github.com/SiFTW/CSV2JuliaDiffEq             #\n')
+        f.write('# include this file with in model running script      #\n')
+        f.write('# defines paramjac!(pJ,y,p,t), the jacobian of the    #\n')
+        f.write('# ODE with respect to the parameter array p[x]        #\n')
+        f.write('#######################################################\n')
+        f.write('\n\n')
+        f.write('function paramjac!(pJ,y,p,t)\n')
+        for line in ODEIndexDict.keys():
+            f.write('\t'+ODEIndexDict[line]+'=maximum([y['+str(line)+'],0])\n')
+        for paramName in timeDependentDict.keys():
+            f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
+        f.write('\tfill!(pJ,0)\n')
+        for line in paramJacLines:
+            f.write(line)
+        f.write('\tnothing\n')
+        f.write('end\n')
+        f.write('println(\"paramjac! can now be passed to the ODE function.\")\n')
+        f.write('println(\"example: ODEFunction(odeFile,paramjac=paramjac!,syms=Symbol.(syms))\")\n')
 
-            except:
-                print('error addding parameters {parametersInThisRxn} to reaction {line}\n'.format(parametersInThisRxn=parametersInThisRxn, line=line))
-                print('error addding parameter: {currentParamInfo}\n'.format(currentParamInfo=currentParamInfo) )
-            thisLaw="".join(newLaw)
+#relative cost of each kind of operation, used to rank equations and rate laws
+operationCosts={'arithmetic':1,'powers':10,'exp':10,'history':20,'paramFun':20,'otherCalls':5,'allocations':50}
 
+def countOperations(expression):
+    #operation counts of a parsed rate law
+    counts=dict.fromkeys(operationCosts.keys(),0)
+    for node in ast.walk(expression):
+        if isinstance(node,ast.BinOp):
+            if isinstance(node.op,ast.Pow):
+                counts['powers']+=1
+            else:
+                counts['arithmetic']+=1
+        elif isinstance(node,ast.UnaryOp) and isinstance(node.op,ast.USub):
+            counts['arithmetic']+=1
+        elif isinstance(node,ast.Call):
+            functionName=node.func.id if isinstance(node.func,ast.Name) else ''
+            if functionName=='exp':
+                counts['exp']+=1
+            elif functionName=='h':
+                counts['history']+=1
+            elif functionName=='paramFun':
+                counts['paramFun']+=1
+            else:
+                counts['otherCalls']+=1
+        elif isinstance(node,ast.List):
+            counts['allocations']+=1
+    return counts
 
-            #we need to add this reaction to every product and substrate involved in this reaction
+def addCounts(totalCounts,counts,multiplier=1):
+    for key in counts.keys():
+        totalCounts[key]+=multiplier*counts[key]
 
-            for thisSubstrate in substratesInThisRxn:
-                if thisSubstrate in ODEDict:
-                    ODEDict[thisSubstrate]=ODEDict[thisSubstrate]+' - '+thisLaw
-                else:
-                    ODEDict[thisSubstrate]='dy['+str(len(ODEDict)+1)+']= -'+thisLaw
-                    ODEIndexDict[len(ODEDict)]=thisSubstrate
-            for thisProduct in productsInThisRxn:
-                if thisProduct in ODEDict:
-                    ODEDict[thisProduct]=ODEDict[thisProduct]+' + '+thisLaw
-                else:
-                    ODEDict[thisProduct]='dy['+str(len(ODEDict)+1)+']= + '+thisLaw
-                    ODEIndexDict[len(ODEDict)]=thisProduct
-            #sometimes a modifier needs an ODE but has no changes other than events
-            for thisModifier in modifiersInThisRxn:
-                if thisModifier not in ODEDict and not thisModifier.startswith("delay("):
-                #if thisModifier not in ODEDict:
-                    ODEDict[thisModifier]='dy['+str(len(ODEDict)+1)+']=0'
-                    ODEIndexDict[len(ODEDict)]=thisModifier
-    #print(ODEDict)
-    writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersDict))
-    if paramType=="scan":
-        writeParamFile(scanIncludesFileName,parametersDict)
-    elif paramType=="param":
-        writePfile(scanIncludesFileName,parametersNameList,parametersIndexValueList)
-           
-def writePfile(scanIncludesFileName,parametersNameList,parametersIndexValueList):
+def operationCost(counts):
+    return sum(operationCosts[key]*counts[key] for key in operationCosts.keys())
+
+def writeCostReport(costFileName,ODEDict,ODEIndexDict,lawNameDict):
+    #static cost of each dy[i] and of each rate law summed over every term it is written in
+    equationCounts=dict()
+    lawCounts=dict()
+    lawTerms=dict()
+    try:
+        for index in ODEIndexDict.keys():
+            species=ODEIndexDict[index]
+            #each species local is read through maximum([y[i],0])
+            equationCounts[species]=countOperations(lawToExpression('maximum([y['+str(index)+'],0])'))
+            for law,coefficient in ODEDict[species].items():
+                if coefficient==0:
+                    continue
+                lawName=lawNameDict[law]
+                counts=countOperations(lawToExpression(law))
+                #joining the term to the equation, plus the multiply for n*(law)
+                counts['arithmetic']+=1 if abs(coefficient)==1 else 2
+                addCounts(equationCounts[species],counts)
+                if lawName not in lawCounts:
+                    lawCounts[lawName]=dict.fromkeys(operationCosts.keys(),0)
+                    lawTerms[lawName]=0
+                addCounts(lawCounts[lawName],counts)
+                lawTerms[lawName]+=1
+    except SyntaxError as e:
+        print('error parsing rate laws for the cost report, no report written: {error}'.format(error=e))
+        return
+
+    with open(costFileName,'w',newline='') as f:
+        csvwriter=csv.writer(f)
+        csvwriter.writerow(['Type','Name','Rank','Cost','Terms']+list(operationCosts.keys()))
+        for rowType,rowCounts in (('equation',equationCounts),('rate law',lawCounts)):
+            ranked=sorted(rowCounts.keys(),key=lambda name:operationCost(rowCounts[name]),reverse=True)
+            for rank,name in enumerate(ranked):
+                terms=lawTerms[name] if rowType=='rate law' else len([c for c in ODEDict[name].values() if c!=0])
+                csvwriter.writerow([rowType,name,rank+1,operationCost(rowCounts[name]),terms]+list(rowCounts[name].values()))
+    print('Cost report written to {file}'.format(file=costFileName))
+
+def writePfile(scanIncludesFileName,parametersNameList,parametersIndexValueList,tdParametersNameList,tdParametersValueList,cells):
     with open(scanIncludesFileName,'w') as f:
         f.write('#######################################################\n')
         f.write('# Generated programmatically by CSV2JuliaDiffEq.      #\n')
         f.write('# http://github.com/SiFTW/CSV2JuliaDiffEq             #\n')
         f.write('# include this file with in model running script      #\n')
-        f.write('# defines all parameter values in an array p[x]       #\n')
+        f.write('# defines all constant parameter values in a Float64  #\n')
+        f.write('# array p[x] and time-dependent parameters as named   #\n')
+        f.write('# functions tdParam_name(t)                           #\n')
         f.write('#      - this model style is compatable with          #\n')
         f.write('#      sensitivities etc                              #\n')
         f.write('#######################################################\n')
         f.write('\n\n')
-        f.write('paramVals=[\n')
+        f.write('paramVals=Float64[\n')
         for index,val in enumerate(parametersIndexValueList):
             f.write(str(parametersIndexValueList[index])+' #p['+str(index+1)+"] is "+parametersNameList[index]+"\n")        
         f.write(']')
         f.write('\n\n')
         f.write('parameterNameList=[')
         for index,val in enumerate(parametersIndexValueList):
-            f.write('\"'+str(parametersNameList[index])+'\" #parameterNameList['+str(index)+"]="+str(parametersIndexValueList[index])+"\n")        
+            f.write('\"'+str(parametersNameList[index])+'\" #parameterNameList['+str(index+1)+"]="+str(parametersIndexValueList[index])+"\n")        
+        f.write(']')
+        f.write('\n\n')
+        if cells>1:
+            #one column of parameters per cell, all starting from the values above
+            f.write('numberOfCells='+str(cells)+'\n')
+            f.write('#parameter k of cell c is paramVals[(c-1)*length(parameterNameList)+k], or reshape(paramVals,:,numberOfCells)[k,c]\n')
+            f.write('paramVals=repeat(paramVals,numberOfCells)')
+            f.write('\n\n')
+        #named functions are const bindings, so the model calls them type stably, and unlike a const
+        #tuple of anonymous functions they can be redefined by including this file again
+        for index,val in enumerate(tdParametersValueList):
+            tdExpression=str(tdParametersValueList[index])
+            if re.match('\s*t\s*->',tdExpression):
+                tdExpression=tdExpression.split('->',1)[1].strip()
+            f.write('tdParam_'+tdParametersNameList[index]+'(t)='+tdExpression+"\n")
+        f.write('\n')
+        f.write('tdParameterNameList=[')
+        for index,val in enumerate(tdParametersValueList):
+            f.write('\"'+str(tdParametersNameList[index])+'\" #tdParameterNameList['+str(index+1)+"]="+str(tdParametersValueList[index])+"\n")
         f.write(']')
         f.write('\n\n')
         f.write('println(\"parameters can now be searched in parameterNameList by name.\")\n')
@@ -275,34 +973,82 @@ def writeParamFile(scanIncludesFileName,parametersDict):
         
 
 
-def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters,):
+def writeInstrumentConstants(f,odeFileName,groupNames):
+    #timers (in ns) and call counters for each instrumented group of the model
+    f.write('const '+odeFileName+'_instrumentGroups=[\n')
+    for groupName in groupNames:
+        f.write('\"'+groupName+'\"\n')
+    f.write(']\n')
+    f.write('const '+odeFileName+'_instrumentTimes=zeros(UInt64,'+str(len(groupNames))+')\n')
+    f.write('const '+odeFileName+'_instrumentCalls=zeros(Int,'+str(len(groupNames))+')\n\n')
+
+def writeInstrumentReport(f,odeFileName):
+    #companion function printing the timers as a table, slowest group first
+    f.write('\n')
+    f.write('function '+odeFileName+'_instrumentReport(;reset=false)\n')
+    f.write('\ttimes='+odeFileName+'_instrumentTimes\n')
+    f.write('\tcalls='+odeFileName+'_instrumentCalls\n')
+    f.write('\ttotal=max(sum(times),1)\n')
+    f.write('\tprintln(rpad(\"group\",40),lpad(\"calls\",12),lpad(\"total ms\",12),lpad(\"mean us\",12),lpad(\"share %\",10))\n')
+    f.write('\tfor g in sortperm(times,rev=true)\n')
+    f.write('\t\tprintln(rpad('+odeFileName+'_instrumentGroups[g],40),lpad(calls[g],12),lpad(round(times[g]/1e6,digits=3),12),lpad(round(times[g]/max(calls[g],1)/1e3,digits=3),12),lpad(round(100*times[g]/total,digits=1),10))\n')
+    f.write('\tend\n')
+    f.write('\tif reset\n')
+    f.write('\t\tfill!(times,0)\n')
+    f.write('\t\tfill!(calls,0)\n')
+    f.write('\tend\n')
+    f.write('end\n')
+
+def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters,timeDependentDict,familyConstants,familyLoops,instrument,instrumentChunkSize,lawVariables,lawNameDict):
     #this function will write the ODE file ready to be called by Julia
 
     with open(outputFile,'w') as f:
-        f.write('#######################################################\n')
-        f.write('# Generated programmatically by CSV2JuliaDiffEq.      #\n')
-        f.write('# http://github.com/SiFTW/CSV2JuliaDiffEq             #\n')
-        f.write('#######################################################\n')
-        f.write('# generated from:\n')
-        f.write('#    reactions file: {file}\n'.format(file=reactionfile))
-        f.write('#    parameters file file: {file}\n'.format(file=parameterfile))
-        f.write('#    rate law file: {file}\n'.format(file=ratelawfile))
-        f.write('#\n')
-        f.write('# Statistics:\n')
-        f.write('#    Equations:{number}\n'.format(number=len(ODEIndexDict)))
-        f.write('#    Parameters:{number}\n'.format(number=numberOfParameters))
-        f.write('#######################################################\n\n')
-        f.write('\n\n')
+        writeModelHeader(f,reactionfile,parameterfile,ratelawfile,len(ODEIndexDict),numberOfParameters)
+        #index arrays for the reaction families evaluated in loops
+        f.write(familyConstants)
         odeFileName=outputFile.split(".")[0]
+        if len(familyLoops)>0:
+            #dy is zeroed first and the loops add to it, so equations without written-out terms are left out
+            ODEDict=dict((key,ODEDict[key]) for key in ODEDict.keys() if not ODEDict[key].endswith('=0'))
+        #with instrument set, the body is split into groups that are each timed and counted
+        instrumentGroups=[]
+        if instrument=="law":
+            lawGroups=dict()
+            for law in lawVariables.keys():
+                lawGroups.setdefault(lawNameDict[law],[]).append('\t'+lawVariables[law]+'='+law+'\n')
+            instrumentGroups+=[(lawName,''.join(lawGroups[lawName])) for lawName in lawGroups.keys()]
+            instrumentGroups.append(('equations',''.join('\t#'+key+'\n\t'+ODEDict[key]+'\n' for key in ODEDict.keys())))
+        elif instrument=="chunk":
+            keys=list(ODEDict.keys())
+            for chunkStart in range(0,len(keys),instrumentChunkSize):
+                chunkKeys=keys[chunkStart:chunkStart+instrumentChunkSize]
+                #named by species index, which differs from the position when equations were left out
+                chunkFirst,chunkLast=[ODEDict[key][3:ODEDict[key].index(']')] for key in (chunkKeys[0],chunkKeys[-1])]
+                instrumentGroups.append(('dy['+chunkFirst+':'+chunkLast+']',''.join('\t#'+key+'\n\t'+ODEDict[key]+'\n' for key in chunkKeys)))
+        elif instrument=="family":
+            instrumentGroups.append(('equations',''.join('\t#'+key+'\n\t'+ODEDict[key]+'\n' for key in ODEDict.keys())))
+        if instrumentGroups:
+            instrumentGroups+=list(familyLoops.items())
+            writeInstrumentConstants(f,odeFileName,[groupName for groupName,groupCode in instrumentGroups])
         odeNameDict=dict()
         if len(delayDict)>0:
             f.write('function {name}(dy,y,h,p,t)\n'.format(name=odeFileName))
         else:
             f.write('function {name}(dy,y,p,t)\n'.format(name=odeFileName))
+        usedNames=None
+        if len(familyLoops)>0:
+            #the loops read y directly, so only species in the written-out terms need a local
+            usedNames=set(re.findall('\w+',' '.join(list(ODEDict.values())+list(lawVariables.keys())+list(timeDependentDict.values())+list(delayDict.values()))))
         #let's deal with time-dependent params
         for line in ODEIndexDict.keys():
-            f.write('\t'+ODEIndexDict[line]+'=maximum([y['+str(line)+'],0])\n')
+            if usedNames is None or ODEIndexDict[line] in usedNames:
+                f.write('\t'+ODEIndexDict[line]+'=maximum([y['+str(line)+'],0])\n')
             odeNameDict[ODEIndexDict[line]]=line
+        if len(familyLoops)>0:
+            f.write('\tfill!(dy,0)\n')
+        #each time-dependent parameter is evaluated once per call
+        for paramName in timeDependentDict.keys():
+            f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
         delayOdeNameList=[]
         for delayEntry in delayDict.keys():
             f.write('\ttau_'+delayEntry+'='+delayDict[delayEntry]+'\n')
@@ -310,18 +1056,151 @@ def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,paramete
             delayOdeNameList.append(odeName)
         for name in delayOdeNameList:
             f.write('\thistindex_'+name+'='+str(odeNameDict[name])+'\n')
+        if instrumentGroups:
+            for groupIndex,(groupName,groupCode) in enumerate(instrumentGroups):
+                if groupName not in familyLoops:
+                    f.write('\t#'+groupName+'\n')
+                f.write('\tinstrumentStart=time_ns()\n')
+                f.write(groupCode)
+                f.write('\t'+odeFileName+'_instrumentTimes['+str(groupIndex+1)+']+=time_ns()-instrumentStart\n')
+                f.write('\t'+odeFileName+'_instrumentCalls['+str(groupIndex+1)+']+=1\n')
+            f.write('end\n')
+            writeInstrumentReport(f,odeFileName)
+        else:
+            for key in ODEDict.keys():
+                f.write('\t#'+key+'\n')
+                f.write('\t'+ODEDict[key]+'\n')
+            f.write(''.join(familyLoops.values()))
+            f.write('end\n')
+
+    writeVariableNames(ODEIndexDict)
+
+def writeStaticODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters,timeDependentDict):
+    #out-of-place form for small models: the derivatives are returned as an SVector, so nothing is
+    #allocated per call. variableNames.jl and the parameter files are the same as for the in-place form
+    with open(outputFile,'w') as f:
+        writeModelHeader(f,reactionfile,parameterfile,ratelawfile,len(ODEIndexDict),numberOfParameters)
+        f.write('using StaticArrays\n\n')
+        odeFileName=outputFile.split(".")[0]
+        odeNameDict=dict()
+        if len(delayDict)>0:
+            f.write('function {name}(y,h,p,t)\n'.format(name=odeFileName))
+        else:
+            f.write('function {name}(y,p,t)\n'.format(name=odeFileName))
+        for line in ODEIndexDict.keys():
+            f.write('\t'+ODEIndexDict[line]+'=max(y['+str(line)+'],0)\n')
+            odeNameDict[ODEIndexDict[line]]=line
+        for paramName in timeDependentDict.keys():
+            f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
+        histIndexWritten=set()
+        for delayEntry in delayDict.keys():
+            f.write('\ttau_'+delayEntry+'='+delayDict[delayEntry]+'\n')
+            odeName=delayEntry.split('_')[0]
+            if odeName not in histIndexWritten:
+                f.write('\thistindex_'+odeName+'='+str(odeNameDict[odeName])+'\n')
+                histIndexWritten.add(odeName)
+        f.write('\treturn SVector{'+str(len(ODEIndexDict))+'}(\n')
         for key in ODEDict.keys():
-            f.write('\t#'+key+'\n')
-            f.write('\t'+ODEDict[key]+'\n')
+            #drop the dy[i]= of the in-place form
+            f.write('\t\t'+ODEDict[key].split('=',1)[1].strip()+', #'+key+'\n')
+        f.write('\t)\n')
         f.write('end\n')
 
-    with open('variableNames.jl','w') as f:
-        f.write('syms=[')
+    writeVariableNames(ODEIndexDict)
+
+def readExchangeFile(exchangeFile,ODEDict,parametersDict,parametersIndexDict):
+    #each row exchanges a species between neighbouring cells at a rate set by a constant parameter
+    print('Opening {file} as exchange file'.format(file=exchangeFile))
+    exchangeList=[]
+    with openInput(exchangeFile) as f:
+        csvreader=csv.reader(f)
+        #skip header row
+        next(csvreader)
+        for line in csvreader:
+            species=line[0].strip()
+            parameter=line[1].strip()
+            if species not in ODEDict or parameter not in parametersDict or "(t)" in parametersDict[parameter]:
+                print('error adding exchange {line}, the species must be in the model and the parameter must be constant'.format(line=line))
+                continue
+            exchangeList.append((species,parametersIndexDict[parameter]))
+    return exchangeList
+
+def writeMultiCellODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters,timeDependentDict,cells,exchangeList):
+    #the same equations for every cell, in a loop over cells. y and dy hold the species of cell c
+    #contiguously from (c-1)*numberOfSpecies+1, and p holds one column of parameters per cell
+    numberOfSpecies=len(ODEIndexDict)
+    odeNameDict=dict((ODEIndexDict[index],index) for index in ODEIndexDict.keys())
+    with open(outputFile,'w') as f:
+        writeModelHeader(f,reactionfile,parameterfile,ratelawfile,numberOfSpecies,numberOfParameters,cells)
+        odeFileName=outputFile.split(".")[0]
+        if len(delayDict)>0:
+            f.write('function {name}(dy,y,h,p,t)\n'.format(name=odeFileName))
+        else:
+            f.write('function {name}(dy,y,p,t)\n'.format(name=odeFileName))
+        #time-dependent parameters and delays are shared by all cells
+        for paramName in timeDependentDict.keys():
+            f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
+        histIndexWritten=set()
+        for delayEntry in delayDict.keys():
+            f.write('\ttau_'+delayEntry+'='+delayDict[delayEntry]+'\n')
+            odeName=delayEntry.split('_')[0]
+            if odeName not in histIndexWritten:
+                f.write('\thistindex_'+odeName+'='+str(odeNameDict[odeName])+'\n')
+                histIndexWritten.add(odeName)
+        f.write('\tfor c in 1:'+str(cells)+'\n')
+        f.write('\t\tyo=(c-1)*'+str(numberOfSpecies)+'\n')
+        f.write('\t\tpo=(c-1)*'+str(numberOfParameters)+'\n')
         for line in ODEIndexDict.keys():
-            f.write('\"'+ODEIndexDict[line]+'\",')
-        f.write(']')
+            f.write('\t\t'+ODEIndexDict[line]+'=maximum([y[yo+'+str(line)+'],0])\n')
+        for key in ODEDict.keys():
+            cellODE=re.sub('^dy\[(\d+)\]','dy[yo+\\1]',ODEDict[key])
+            cellODE=re.sub('(?<![\w.])p\[(\d+)\]','p[po+\\1]',cellODE)
+            cellODE=cellODE.replace('[histindex_','[yo+histindex_')
+            f.write('\t\t#'+key+'\n')
+            f.write('\t\t'+cellODE+'\n')
+        f.write('\tend\n')
+        for species,paramIndex in exchangeList:
+            f.write('\t#exchange of '+species+' between neighbouring cells\n')
+            f.write('\tfor c in 1:'+str(cells-1)+'\n')
+            f.write('\t\tyo=(c-1)*'+str(numberOfSpecies)+'\n')
+            f.write('\t\tv=p[(c-1)*'+str(numberOfParameters)+'+'+str(paramIndex)+']*(max(y[yo+'+str(odeNameDict[species])+'],0)-max(y[yo+'+str(numberOfSpecies+odeNameDict[species])+'],0))\n')
+            f.write('\t\tdy[yo+'+str(odeNameDict[species])+']-=v\n')
+            f.write('\t\tdy[yo+'+str(numberOfSpecies+odeNameDict[species])+']+=v\n')
+            f.write('\tend\n')
+        f.write('end\n')
+
+    writeVariableNames(ODEIndexDict,cells)
+
+def wholeNumberOption(name,value,default,minimum=1):
+    #options that count something fall back to their default, with a message, if given anything else
+    if type(value) is not int or value<minimum:
+        print('{name} has to be a whole number of at least {minimum}, {name}={default} was used'.format(name=name,minimum=minimum,default=default))
+        return default
+    return value
+
+def parseOptions(optionArguments):
+    #optional arguments after the 5th are given as name=value, e.g. paramJac=true.
+    #returns None if any of them is not recognised
+    knownOptions=list(inspect.signature(csv2model).parameters.keys())[5:]
+    options=dict()
+    for argument in optionArguments:
+        name,separator,value=argument.partition('=')
+        if not separator or name not in knownOptions:
+            print('The argument {argument} was not recognised, optional arguments are written as name=value, please choose from: {options}'.format(argument=argument,options=', '.join(knownOptions)))
+            return None
+        if value.lower() in ('true','false'):
+            options[name]=value.lower()=='true'
+        elif value.isdigit():
+            options[name]=int(value)
+        else:
+            options[name]=value
+    return options
 
 if len(sys.argv)==5:
     csv2model(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4])
 elif len(sys.argv)==6:
     csv2model(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4],sys.argv[5])
+elif len(sys.argv)>6:
+    options=parseOptions(sys.argv[6:])
+    if options is not None:
+        csv2model(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4],sys.argv[5],**options)
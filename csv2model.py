@@ -2,6 +2,9 @@
 import sys
 import csv
 import re
+import io
+import gzip
+import lzma
 
 def csv2model(reactionfile,parameterfile,ratelawfile,outputFile,paramType="inline"):
     scanIncludesFileName="scanIncludes.jl"
@@ -17,9 +20,10 @@ If this is incorrect, please re-run with 5th argument set to \'inline\'')
     print('Opening {file} as rate law file'.format(file=ratelawfile))
     ratelaws=dict()
     delayDict=dict()
+    timeDependentDict=dict()
     ODEIndexDict=dict()
     #let's populate a string array of rate laws
-    with open(ratelawfile,'r') as f:
+    with openInput(ratelawfile) as f:
         csvreader=csv.reader(f)
         #skip header row
         next(csvreader)
@@ -30,7 +34,7 @@ If this is incorrect, please re-run with 5th argument set to \'inline\'')
     #let's populate the parameter list
     print('Opening {file} as parameters file'.format(file=parameterfile))
     parametersDict=dict()
-    with open(parameterfile,'r') as f:
+    with openInput(parameterfile) as f:
         csvreader=csv.reader(f)
         #skpip header row
         next(csvreader)
@@ -40,7 +44,7 @@ If this is incorrect, please re-run with 5th argument set to \'inline\'')
 
     #let's iterate through the reaction file
     print('Opening {file} as reactions file'.format(file=reactionfile))
-    with open(reactionfile,'r') as f:
+    with openInput(reactionfile) as f:
         csvreader=csv.reader(f)
         #skip header row
         next(csvreader)
@@ -149,10 +153,14 @@ If this is incorrect, please re-run with 5th argument set to \'inline\'')
                                     if "(t)" not in parametersDict[parametersInThisRxn[j]]:
                                         newLaw+=list("paramFun(\""+str(parametersInThisRxn[j])+"\",modify)")
                                     else:
-                                        newLaw+=list(str(parametersDict[parametersInThisRxn[j]]))                                    
+                                        newLaw+=list(addTimeDependentParam(timeDependentDict,parametersInThisRxn[j],str(parametersDict[parametersInThisRxn[j]])))
                                     parameterAdded=1
                                 else:
-                                    newLaw+=list(str(parametersDict[parametersInThisRxn[j]]))
+                                    thisParamVal=str(parametersDict[parametersInThisRxn[j]])
+                                    if "(t)" in thisParamVal:
+                                        newLaw+=list(addTimeDependentParam(timeDependentDict,parametersInThisRxn[j],thisParamVal))
+                                    else:
+                                        newLaw+=list(thisParamVal)
                                     parameterAdded=1
                         else:
                             if not parameterAdded:
@@ -166,31 +174,68 @@ If this is incorrect, please re-run with 5th argument set to \'inline\'')
 
 
             #we need to add this reaction to every product and substrate involved in this reaction
-
+            #the net stoichiometry is accumulated per species so catalysts cancel and duplicates merge
             for thisSubstrate in substratesInThisRxn:
-                if thisSubstrate in ODEDict:
-                    ODEDict[thisSubstrate]=ODEDict[thisSubstrate]+' - '+thisLaw
-                else:
-                    ODEDict[thisSubstrate]='dy['+str(len(ODEDict)+1)+']= -'+thisLaw
-                    ODEIndexDict[len(ODEDict)]=thisSubstrate
+                addODETerm(ODEDict,ODEIndexDict,thisSubstrate,thisLaw,-1)
             for thisProduct in productsInThisRxn:
-                if thisProduct in ODEDict:
-                    ODEDict[thisProduct]=ODEDict[thisProduct]+' + '+thisLaw
-                else:
-                    ODEDict[thisProduct]='dy['+str(len(ODEDict)+1)+']= + '+thisLaw
-                    ODEIndexDict[len(ODEDict)]=thisProduct
+                addODETerm(ODEDict,ODEIndexDict,thisProduct,thisLaw,1)
             #sometimes a modifier needs an ODE but has no changes other than events
             for thisModifier in modifiersInThisRxn:
                 if thisModifier not in ODEDict and not thisModifier.startswith("delay("):
                 #if thisModifier not in ODEDict:
-                    ODEDict[thisModifier]='dy['+str(len(ODEDict)+1)+']=0'
+                    ODEDict[thisModifier]=dict()
                     ODEIndexDict[len(ODEDict)]=thisModifier
     #print(ODEDict)
-    writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersDict))
+    writeODEFile(netStoichiometryToODEs(ODEDict,ODEIndexDict),outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,len(parametersDict),timeDependentDict)
     if paramType=="scan":
         writeParamFile(scanIncludesFileName,parametersDict)
 
 
+def openInput(fileName):
+    #input tables may be gzip, xz or zstd compressed, chosen by file extension
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName,'rt')
+    elif fileName.endswith('.xz'):
+        return lzma.open(fileName,'rt')
+    elif fileName.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading {file} requires the zstandard package'.format(file=fileName))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(fileName,'rb')))
+    return open(fileName,'r')
+
+def addTimeDependentParam(timeDependentDict,paramName,paramExpression):
+    #time-dependent parameters are hoisted into a td_ local at the top of the ODE function
+    timeDependentDict[paramName]=paramExpression
+    return 'td_'+paramName
+
+def addODETerm(ODEDict,ODEIndexDict,species,law,coefficient):
+    #ODEDict maps each species to {rendered law: net integer stoichiometry}
+    if species not in ODEDict:
+        ODEDict[species]=dict()
+        ODEIndexDict[len(ODEDict)]=species
+    ODEDict[species][law]=ODEDict[species].get(law,0)+coefficient
+
+def netStoichiometryToODEs(ODEDict,ODEIndexDict):
+    #render the accumulated terms, dropping zero-net terms and writing repeated ones as n*(law)
+    ODEStringDict=dict()
+    for index in ODEIndexDict.keys():
+        species=ODEIndexDict[index]
+        ODEString='dy['+str(index)+']='
+        for law,coefficient in ODEDict[species].items():
+            if coefficient==0:
+                continue
+            sign=' + ' if coefficient>0 else ' - '
+            if abs(coefficient)==1:
+                ODEString+=sign+law
+            else:
+                ODEString+=sign+str(abs(coefficient))+'*('+law+')'
+        if ODEString.endswith('='):
+            ODEString+='0'
+        ODEStringDict[species]=ODEString
+    return ODEStringDict
+
 def writeParamFile(scanIncludesFileName,parametersDict):
     with open(scanIncludesFileName,'w') as f:
         f.write('#######################################################\n')
@@ -225,7 +270,7 @@ def writeParamFile(scanIncludesFileName,parametersDict):
         f.write('println(\"modify[\\\"k_binding\\\"]=1.5\")\n')
 
 
-def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters):
+def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,parameterfile,ratelawfile,numberOfParameters,timeDependentDict):
     #this function will write the ODE file ready to be called by Julia
 
     with open(outputFile,'w') as f:
@@ -252,6 +297,9 @@ def writeODEFile(ODEDict,outputFile,delayDict,ODEIndexDict,reactionfile,paramete
         for line in ODEIndexDict.keys():
             f.write('\t'+ODEIndexDict[line]+'=y['+str(line)+']\n')
             odeNameDict[ODEIndexDict[line]]=line
+        #each time-dependent parameter is evaluated once per call
+        for paramName in timeDependentDict.keys():
+            f.write('\ttd_'+paramName+'='+timeDependentDict[paramName]+'\n')
         delayOdeNameList=[]
         for delayEntry in delayDict.keys():
             f.write('\ttau_'+delayEntry+'='+delayDict[delayEntry]+'\n')